@@ -9,47 +9,55 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import requests
-import matplotlib.pyplot as plt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import diskcache
 
 from datetime import datetime, timedelta, date
 from io import BytesIO
-
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
-
-import textwrap
-
-def draw_wrapped_text(c, text, x, y, max_width=90, leading=14, font="Helvetica", size=10):
-    """
-    Escreve texto no PDF com quebra automática de linha.
-    Retorna o novo valor de y após desenhar o texto.
-    """
-    c.setFont(font, size)
-    text_obj = c.beginText(x, y)
-    text_obj.setLeading(leading)
-
-    linhas = textwrap.wrap(text, width=max_width) if text else []
-    for linha in linhas:
-        text_obj.textLine(linha)
-
-    c.drawText(text_obj)
-    return y - (len(linhas) * leading)
+import math
+import time
+import warnings
 
 # ============================================================
 # CONFIG
 # ============================================================
 st.set_page_config(page_title="DairyClime", page_icon="🐄", layout="wide")
 
+# Validade do cache em disco do NASA POWER (ver cache_nasa).
+# Dados diários de períodos passados não mudam, então a validade pode ser longa.
+# Depois de vencida, a cópia ainda é guardada por um ano e usada se a API falhar.
+CACHE_NASA_VALIDADE_S = 30 * 86400
+CACHE_NASA_RETENCAO_S = 365 * 86400
+
+# Acima disso as barras ficam mais finas que um pixel
+MAX_BARRAS = 300
+
 # ============================================================
 # FUNÇÕES
 # ============================================================
+# Limites superiores (inclusivos) de Normal, Alerta e Perigo
+LIMITES_ITU = [70.0, 78.0, 82.0]
+CLASSES_ITU = np.array(["Normal", "Alerta", "Perigo", "Emergência"])
+CORES_ITU = np.array(["#2E7D32", "#F9A825", "#EF6C00", "#C62828"])  # verde, amarelo, laranja, vermelho
+NOMES_MESES = np.array(["Jan", "Fev", "Mar", "Abr", "Mai", "Jun", "Jul", "Ago", "Set", "Out", "Nov", "Dez"])
+
+
 def calcular_itu(ta_c, ur_pct):
     """
     ITU = 0,8×Ta + (UR×(Ta−14,3))/100 + 46,3
     Ta em °C; UR em %
+
+    Aceita valores escalares (modo manual) ou arrays NumPy (série diária);
+    com arrays, acumula no próprio resultado para evitar temporários.
     """
-    return 0.8 * ta_c + (ur_pct * (ta_c - 14.3)) / 100.0 + 46.3
+    itu = np.subtract(ta_c, 14.3)
+    itu *= ur_pct
+    itu *= 0.01
+    itu += 46.3
+    itu += 0.8 * ta_c
+    return itu
 
 
 def classificar_itu(itu):
@@ -64,6 +72,23 @@ def classificar_itu(itu):
         return "Emergência"
 
 
+def indice_classe_itu(itu):
+    """
+    Versão vetorizada de classificar_itu: devolve o índice da classe
+    (0=Normal, 1=Alerta, 2=Perigo, 3=Emergência) para cada valor de ITU.
+    """
+    return np.digitize(itu, LIMITES_ITU, right=True)
+
+
+def frequencia_classes(idx_classe):
+    """
+    Percentual de dias em cada classe (Normal, Alerta, Perigo, Emergência),
+    calculado numa única contagem sobre os índices de indice_classe_itu.
+    """
+    contagem = np.bincount(idx_classe, minlength=len(CLASSES_ITU))
+    return contagem / contagem.sum() * 100
+
+
 def recomendacao_por_classe(classe):
     # Linguagem acessível (produtor/técnico)
     if classe == "Normal":
@@ -76,14 +101,7 @@ def recomendacao_por_classe(classe):
 
 
 def cor_por_itu(itu):
-    if itu <= 70:
-        return "#2E7D32"  # verde
-    elif itu <= 78:
-        return "#F9A825"  # amarelo
-    elif itu <= 82:
-        return "#EF6C00"  # laranja
-    else:
-        return "#C62828"  # vermelho
+    return str(CORES_ITU[indice_classe_itu(itu)])
 
 
 def diagnostico_periodo(media_itu, p_alerta, p_perigo, p_emerg):
@@ -101,10 +119,68 @@ def diagnostico_periodo(media_itu, p_alerta, p_perigo, p_emerg):
             f"Tivemos {p_emerg:.1f}% dos dias em emergência. Priorize resfriamento imediato e constante.")
 
 
-@st.cache_data(show_spinner=False)
+def ajustar_grade_nasa(lat, lon, passo_lat=0.5, passo_lon=0.625):
+    """
+    Leva as coordenadas ao centro da célula da grade MERRA-2 usada pela
+    NASA POWER para T2M/RH2M (0,5° lat × 0,625° lon). Pontos na mesma célula
+    recebem os mesmos dados e compartilham o cache.
+    Empates são arredondados sempre para cima (round() arredonda para o par).
+    """
+    return (math.floor(lat / passo_lat + 0.5) * passo_lat,
+            math.floor(lon / passo_lon + 0.5) * passo_lon)
+
+
+@st.cache_resource(show_spinner=False)
+def cache_nasa():
+    """
+    Cache em disco das respostas do NASA POWER (sobrevive a reinícios do app).
+    Aberto uma única vez por processo, e não a cada rerun do script.
+    """
+    return diskcache.Cache("/tmp/dairyclime_cache")
+
+
+@st.cache_resource(show_spinner=False)
+def sessao_nasa():
+    """
+    Sessão HTTP compartilhada entre reruns (keep-alive/TLS reaproveitados),
+    com novas tentativas em falhas temporárias.
+    """
+    sessao = requests.Session()
+    sessao.mount("https://", HTTPAdapter(max_retries=Retry(
+        total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+    )))
+    return sessao
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
 def obter_dados_nasa_power(lat, lon, data_ini_yyyymmdd, data_fim_yyyymmdd):
     """
-    Busca Ta (T2M) e UR (RH2M) diários na NASA POWER.
+    Busca Ta (T2M) e UR (RH2M) diários na NASA POWER, passando pelo cache
+    em disco. Se a API falhar, usa a última cópia salva (mesmo vencida).
+    """
+    chave = f"{lat:.4f}_{lon:.4f}_{data_ini_yyyymmdd}_{data_fim_yyyymmdd}"
+    cache = cache_nasa()
+    salvo = cache.get(chave)  # (instante do download, df)
+    if salvo is not None and time.time() - salvo[0] < CACHE_NASA_VALIDADE_S:
+        return salvo[1]
+
+    try:
+        df = baixar_dados_nasa_power(lat, lon, data_ini_yyyymmdd, data_fim_yyyymmdd)
+    except (requests.RequestException, orjson.JSONDecodeError, KeyError):
+        # falha de rede ou resposta fora do formato esperado (API degradada)
+        if salvo is None:
+            raise
+        st.warning("⚠️ NASA POWER indisponível no momento. Exibindo dados salvos em "
+                   f"{datetime.fromtimestamp(salvo[0]).strftime('%d/%m/%Y')}.")
+        return salvo[1]
+
+    cache.set(chave, (time.time(), df), expire=CACHE_NASA_RETENCAO_S)
+    return df
+
+
+def baixar_dados_nasa_power(lat, lon, data_ini_yyyymmdd, data_fim_yyyymmdd):
+    """
+    Faz a requisição à NASA POWER e converte a resposta em DataFrame.
     """
     url = (
         "https://power.larc.nasa.gov/api/temporal/daily/point"
@@ -115,26 +191,66 @@ def obter_dados_nasa_power(lat, lon, data_ini_yyyymmdd, data_fim_yyyymmdd):
         f"&format=JSON"
     )
 
-    r = requests.get(url, timeout=60)
+    r = sessao_nasa().get(url, timeout=60)
     r.raise_for_status()
-    js = r.json()
+    js = orjson.loads(r.content)
 
     params = js["properties"]["parameter"]
     t2m = params.get("T2M", {})
     rh2m = params.get("RH2M", {})
 
-    df = pd.DataFrame({
-        "Data": list(t2m.keys()),
-        "Ta": list(t2m.values()),
-        "UR": list(rh2m.values())
-    })
+    # Arrays tipados direto do JSON (sem listas intermediárias nem to_numeric)
+    n = len(t2m)
+    datas = pd.to_datetime(np.fromiter(t2m.keys(), dtype="U8", count=n),
+                           format="%Y%m%d", errors="coerce").to_numpy()
+    ta = np.fromiter(t2m.values(), dtype=np.float64, count=n)
+    ur = np.fromiter((rh2m.get(k, np.nan) for k in t2m), dtype=np.float64, count=n)
 
-    df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
-    df["Ta"] = pd.to_numeric(df["Ta"], errors="coerce")
-    df["UR"] = pd.to_numeric(df["UR"], errors="coerce")
+    # NASA POWER usa -999 como valor ausente
+    ta = np.where(ta <= -900, np.nan, ta)
+    ur = np.where(ur <= -900, np.nan, ur)
+    ok = ~(np.isnat(datas) | np.isnan(ta) | np.isnan(ur))
+    datas, ta, ur = datas[ok], ta[ok], ur[ok]
 
-    df = df.dropna(subset=["Data", "Ta", "UR"]).sort_values("Data").reset_index(drop=True)
-    return df
+    # A API já devolve os dias em ordem; só ordena se vier fora de ordem
+    if np.any(np.diff(datas.view("i8")) < 0):
+        ordem = np.argsort(datas, kind="stable")
+        datas, ta, ur = datas[ordem], ta[ordem], ur[ordem]
+
+    return pd.DataFrame({"Data": datas, "Ta": ta, "UR": ur})
+
+
+def reduzir_barras(df_plot, n_max=MAX_BARRAS):
+    """
+    Limita o gráfico a n_max barras sem esconder os extremos: divide a série
+    em n_max/2 blocos e mantém o mínimo e o máximo de ITU de cada bloco.
+    """
+    n = len(df_plot)
+    if n <= n_max:
+        return df_plot
+
+    itu = df_plot["ITU"].to_numpy()
+    limites = np.linspace(0, n, n_max // 2 + 1).astype(int)
+    idx = []
+    for ini, fim in zip(limites[:-1], limites[1:]):
+        bloco = itu[ini:fim]
+        idx.append(ini + np.argmin(np.where(np.isnan(bloco), np.inf, bloco)))
+        idx.append(ini + np.argmax(np.where(np.isnan(bloco), -np.inf, bloco)))
+
+    return df_plot.iloc[np.unique(idx)].reset_index(drop=True)
+
+
+def media_itu_por_data(df, chaves):
+    """
+    Média do ITU agrupada pelas datas em `chaves` (uma por linha de df),
+    sem reindexar nem copiar as demais colunas.
+    """
+    return (
+        df["ITU"].groupby(chaves, sort=True)
+                 .mean()
+                 .rename_axis("Data")
+                 .reset_index()
+    )
 
 
 def preparar_df_plot(df, data_ini, data_fim):
@@ -148,49 +264,58 @@ def preparar_df_plot(df, data_ini, data_fim):
     dias = (data_fim - data_ini).days + 1
 
     if dias <= 15:
-        df_plot = df[["Data", "ITU"]].copy()
+        df_plot = reduzir_barras(df[["Data", "ITU"]].copy())
         df_plot["Label"] = df_plot["Data"].dt.strftime("%d/%m")
         titulo = "ITU Diário"
 
     elif dias <= 90:
-        df_plot = (
-            df.set_index("Data")[["ITU"]]
-              .resample("5D")
-              .mean()
-              .reset_index()
-        )
+        # blocos de 5 dias contados a partir do primeiro dia
+        datas = df["Data"].to_numpy()
+        passo = np.timedelta64(5, "D")
+        df_plot = media_itu_por_data(df, datas[0] + (datas - datas[0]) // passo * passo)
         df_plot["Label"] = df_plot["Data"].dt.strftime("%d/%m")
         titulo = "ITU (Média a cada 5 dias)"
 
     elif dias < 365:
-        df_plot = (
-            df.set_index("Data")[["ITU"]]
-              .resample("M")
-              .mean()
-              .reset_index()
-        )
+        df_plot = media_itu_por_data(df, df["Data"].to_numpy().astype("datetime64[M]"))
         df_plot["Label"] = df_plot["Data"].dt.strftime("%b/%Y")  # ex: Jan/2022
         titulo = "ITU Médio Mensal"
 
     else:
         # climatologia mensal (12 barras) — ideal para muitos anos
-        df_tmp = df.copy()
-        df_tmp["Mes"] = df_tmp["Data"].dt.month
-        df_plot = (
-            df_tmp.groupby("Mes", as_index=False)["ITU"]
-                  .mean()
-        )
-        mapa_mes = {1:"Jan",2:"Fev",3:"Mar",4:"Abr",5:"Mai",6:"Jun",7:"Jul",8:"Ago",9:"Set",10:"Out",11:"Nov",12:"Dez"}
-        df_plot["Label"] = df_plot["Mes"].map(mapa_mes)
+        mes = df["Data"].dt.month.to_numpy()
+        somas = np.bincount(mes, weights=df["ITU"].to_numpy(), minlength=13)[1:]
+        contagens = np.bincount(mes, minlength=13)[1:]
+        tem = contagens > 0
+        df_plot = pd.DataFrame({
+            "Mes": np.arange(1, 13)[tem],
+            "ITU": somas[tem] / contagens[tem],
+            "Label": NOMES_MESES[tem]
+        })
         titulo = "ITU Médio Mensal (média de todos os anos)"
 
     return df_plot, titulo
 
 
+# matplotlib e reportlab são importados sob demanda (aqui e em
+# gerar_pdf_relatorio) para não pesar no carregamento de cada rerun.
+def carregar_pyplot():
+    """
+    Importa o pyplot só quando um gráfico é gerado, já com o backend Agg
+    (raster sem janela; o app só gera imagens).
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+@st.cache_data(show_spinner=False)
 def plot_barras_itu(df_plot, titulo, altura=4.2, largura=9.2):
+    plt = carregar_pyplot()
     fig, ax = plt.subplots(figsize=(largura, altura))
 
-    cores = [cor_por_itu(v) for v in df_plot["ITU"]]
+    cores = CORES_ITU[indice_classe_itu(df_plot["ITU"].to_numpy())].tolist()
     bars = ax.bar(df_plot["Label"], df_plot["ITU"], color=cores)
 
     ax.axhline(70, linestyle="--", linewidth=1)
@@ -207,35 +332,60 @@ def plot_barras_itu(df_plot, titulo, altura=4.2, largura=9.2):
             if i % step != 0:
                 label.set_visible(False)
 
-    for bar, val in zip(bars, df_plot["ITU"]):
-        h = bar.get_height()
-        if h >= 10:
-            ax.text(
-                bar.get_x() + bar.get_width()/2,
-                h/2,
-                f"{val:.1f}",
-                ha="center", va="center",
-                color="white",
-                fontsize=9,
-                fontweight="bold"
-            )
+    alturas = df_plot["ITU"].to_numpy()
+    rotulos = np.where(alturas >= 10, np.char.mod("%.1f", alturas), "")
+    ax.bar_label(
+        bars,
+        labels=rotulos,
+        label_type="center",
+        color="white",
+        fontsize=9,
+        fontweight="bold"
+    )
 
     plt.xticks(rotation=0)
     plt.tight_layout()
-    return fig
+
+    # PNG gerado uma única vez: usado na tela e no PDF
+    buf = BytesIO()
+    fig.savefig(buf, format="png", dpi=150, bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def verificar_rl_accel():
+    """
+    Avisa (uma vez por processo) se os aceleradores em C do reportlab não
+    estiverem instalados.
+    """
+    try:
+        import _rl_accel  # noqa: F401  (aceleradores em C usados internamente pelo reportlab)
+    except ImportError:
+        warnings.warn("rl_accel não instalado: o reportlab usará a versão em Python puro (PDF mais lento).")
+        return False
+    return True
+
 
 def gerar_pdf_relatorio(nome_local, lat, lon, data_ini, data_fim,
                         media_itu, classe_media, diag_texto,
                         p_alerta, p_perigo, p_emerg,
-                        fig_matplotlib):
+                        png_grafico):
     """
     Gera PDF e embute o gráfico (mesmas cores).
     """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader, simpleSplit
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.platypus import Paragraph
+
+    verificar_rl_accel()
+
     if nome_local is None or str(nome_local).strip() == "":
         nome_local = "Local não informado"
 
     buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
+    c = canvas.Canvas(buffer, pagesize=A4, pageCompression=1)
     w, h = A4
 
     y = h - 50
@@ -281,21 +431,18 @@ def gerar_pdf_relatorio(nome_local, lat, lon, data_ini, data_fim,
         "do estresse térmico."
     )
 
-    y = draw_wrapped_text(
-        c,
-        texto_institucional,
-        x=40,
-        y=y,
-        max_width=95,   # largura visual adequada ao A4
-        leading=14,
-        font="Helvetica",
-        size=11
-    )
+    # Parágrafo quebrado pelo próprio reportlab na largura útil da página;
+    # o topo fica alinhado à linha de base atual (y), como nos drawString
+    estilo = ParagraphStyle("Institucional", parent=getSampleStyleSheet()["BodyText"],
+                            fontName="Helvetica", fontSize=11, leading=14)
+    paragrafo = Paragraph(texto_institucional, estilo)
+    _, altura_par = paragrafo.wrapOn(c, w - 80, y)
+    paragrafo.drawOn(c, 40, y + 11 - altura_par)
+    y -= altura_par
 
     y -= 20
 
-
-        # =========================
+    # =========================
     # 4) RESULTADOS
     # =========================
     c.setFont("Helvetica-Bold", 13)
@@ -315,16 +462,10 @@ def gerar_pdf_relatorio(nome_local, lat, lon, data_ini, data_fim,
     diag_txt = "" if diag_texto is None else str(diag_texto)
     diag_txt = " ".join(diag_txt.split())  # limpa espaços extras
     
-    # QUEBRA SOMENTE EM ". " (ponto final de frase)
-    frases_diag = diag_txt.split(". ")
-    
-    for frase in frases_diag[:3]:
-        frase = frase.strip()
-        if frase:
-            if not frase.endswith("."):
-                frase += "."
-            c.drawString(50, y, frase)
-            y -= 14
+    # Quebra pela largura real do texto (fonte Helvetica 11)
+    for linha in simpleSplit(diag_txt, "Helvetica", 11, w - 90):
+        c.drawString(50, y, linha)
+        y -= 14
     
     y -= 10
     
@@ -354,29 +495,19 @@ def gerar_pdf_relatorio(nome_local, lat, lon, data_ini, data_fim,
     rec_txt = recomendacao_por_classe(classe_media)
     rec_txt = " ".join(rec_txt.split())
     
-    frases_rec = rec_txt.split(". ")
-    
-    for frase in frases_rec[:3]:
-        frase = frase.strip()
-        if frase:
-            if not frase.endswith("."):
-                frase += "."
-            c.drawString(50, y, frase)
-            y -= 14
+    for linha in simpleSplit(rec_txt, "Helvetica", 11, w - 90):
+        c.drawString(50, y, linha)
+        y -= 14
 
 
     # =========================
     # 5) GRÁFICO
     # =========================
-    img_buf = BytesIO()
-    fig_matplotlib.savefig(img_buf, format="png", dpi=200, bbox_inches="tight")
-    img_buf.seek(0)
-
     c.showPage()
     c.setFont("Helvetica-Bold", 14)
     c.drawString(40, h - 50, "Gráfico do ITU (Índice de Temperatura e Umidade)")
 
-    img = ImageReader(img_buf)
+    img = ImageReader(BytesIO(png_grafico))
     img_w = w - 80
     img_h = 320
     c.drawImage(
@@ -524,10 +655,13 @@ if st.button("🔍 Analisar Conforto Térmico"):
         st.error("Digite coordenadas válidas (ex.: -5.1234).")
         st.stop()
 
+    lat_grade, lon_grade = ajustar_grade_nasa(lat_f, lon_f)
+    st.caption(f"Ponto da grade NASA POWER usado: Latitude {lat_grade:.3f} | Longitude {lon_grade:.3f}")
+
     with st.spinner("Buscando dados diários do NASA POWER..."):
         try:
             df = obter_dados_nasa_power(
-                lat_f, lon_f,
+                lat_grade, lon_grade,
                 data_ini.strftime("%Y%m%d"),
                 data_fim.strftime("%Y%m%d")
             )
@@ -541,16 +675,15 @@ if st.button("🔍 Analisar Conforto Térmico"):
         st.stop()
 
     # Cálculo ITU
-    df["ITU"] = calcular_itu(df["Ta"], df["UR"])
-    df["Classe"] = df["ITU"].apply(classificar_itu)
+    df["ITU"] = calcular_itu(df["Ta"].to_numpy(), df["UR"].to_numpy())
+    idx_classe = indice_classe_itu(df["ITU"].to_numpy())
+    df["Classe"] = CLASSES_ITU[idx_classe]
 
     media_itu = float(df["ITU"].mean())
     classe_media = classificar_itu(media_itu)
 
     # Percentuais
-    p_alerta = (df["Classe"] == "Alerta").mean() * 100
-    p_perigo = (df["Classe"] == "Perigo").mean() * 100
-    p_emerg = (df["Classe"] == "Emergência").mean() * 100
+    p_norm, p_alerta, p_perigo, p_emerg = frequencia_classes(idx_classe)
 
     diag = diagnostico_periodo(media_itu, p_alerta, p_perigo, p_emerg)
 
@@ -558,13 +691,13 @@ if st.button("🔍 Analisar Conforto Térmico"):
     df_plot, titulo = preparar_df_plot(df, data_ini, data_fim)
 
     # Gráfico (tamanho consistente e legível)
-    fig = plot_barras_itu(df_plot, titulo, altura=4.2, largura=9.2)
+    png_grafico = plot_barras_itu(df_plot, titulo, altura=4.2, largura=9.2)
 
     # Mostrar período sem poluir eixos
     st.caption(f"Período selecionado: {data_ini.strftime('%d/%m/%Y')} → {data_fim.strftime('%d/%m/%Y')}")
 
     # Exibir gráfico
-    st.pyplot(fig, clear_figure=False)
+    st.image(png_grafico)
 
     # CARD do resultado
     st.markdown(
@@ -602,7 +735,7 @@ if st.button("🔍 Analisar Conforto Térmico"):
         classe_media=classe_media,
         diag_texto=diag,
         p_alerta=p_alerta, p_perigo=p_perigo, p_emerg=p_emerg,
-        fig_matplotlib=fig
+        png_grafico=png_grafico
     )
 
     st.download_button(